@@ -1,8 +1,17 @@
 import os
 import json
+import logging
+import time
+import hashlib
+from dataclasses import dataclass
+import orjson
 import requests
-import tempfile
-import mimetypes
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.api_core import exceptions as gcs_exceptions
 from google.cloud import storage
 import functions_framework
 
@@ -10,34 +19,118 @@ import functions_framework
 ELEVENLABS_API_KEY = os.getenv('ELEVEN_LABS_API_KEY')
 ELEVENLABS_AGENT_ID = os.getenv('AGENT_ID')
 ELEVENLABS_API_URL = "https://api.elevenlabs.io/v1"
+MAX_WORKERS = 8
+HTTP_POOL_SIZE = 32 # Comfortably above MAX_WORKERS so parallel calls never wait on a connection
+KB_PAGE_SIZE = 100 # Largest page the knowledge-base list endpoint accepts
+REQUEST_TIMEOUT = (5, 30) # (connect, read) seconds, keeps a stalled socket from eating the function budget
+UPLOAD_TIMEOUT = (5, 300)
 
-# Initialize Storage Client
-storage_client = storage.Client()
+# Map extensions to ElevenLabs specific allowed types
+EXT_MIME = {
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.pdf': 'application/pdf',
+    '.txt': 'text/plain',
+    '.epub': 'application/epub+zip',
+    '.html': 'text/html',
+    '.md': 'text/markdown'
+}
+
+# Cached {filename: {id, md5}} map kept in the monitored bucket itself
+MANIFEST_BLOB_NAME = ".el_manifest.json"
+MANIFEST_VERSION = 2
+MANIFEST_MAX_AGE = 3600 # Seconds before a full ElevenLabs reconcile is forced
+MANIFEST_SAVE_ATTEMPTS = 5 # Rebase-and-retry rounds when concurrent events race on the manifest
+
+FINALIZED_EVENT = "google.cloud.storage.object.v1.finalized"
+DELETED_EVENT = "google.cloud.storage.object.v1.deleted"
+
+MAX_LOGGED_ERRORS = 10 # Failures included verbatim in the per-sync summary
+
+# Per-file detail is DEBUG, each sync emits a single summary record at INFO
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    LOG_LEVEL = "INFO" # Unknown names would make basicConfig raise at import
+logging.basicConfig(level=LOG_LEVEL, format="%(message)s")
+logger = logging.getLogger(__name__)
+
+@dataclass(slots=True)
+class Doc:
+    """A knowledge-base document attached (or to be attached) to the agent."""
+    id: str
+    name: str
+    md5: str | None = None
+
+# Shared HTTP session so every ElevenLabs call reuses pooled connections
+SESSION = requests.Session()
+SESSION.headers.update({"xi-api-key": ELEVENLABS_API_KEY})
+# Retry rate limits, transient server errors and connection resets with backoff before surfacing them
+RETRY = Retry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["GET", "PATCH", "DELETE"]),
+    respect_retry_after_header=True,
+    raise_on_status=False # Hand the last response back so callers can log it
+)
+SESSION.mount("https://", HTTPAdapter(max_retries=RETRY, pool_maxsize=HTTP_POOL_SIZE, pool_block=False))
+
+# Uploads are not idempotent: a POST the server may have processed (read error, 502/504)
+# would create an untracked duplicate doc, so only connect failures and 429 are retried
+UPLOAD_SESSION = requests.Session()
+UPLOAD_SESSION.headers.update({"xi-api-key": ELEVENLABS_API_KEY})
+UPLOAD_RETRY = Retry(
+    total=5,
+    read=0,
+    backoff_factor=0.5,
+    status_forcelist=(429,),
+    allowed_methods=frozenset(["POST"]),
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+UPLOAD_SESSION.mount("https://", HTTPAdapter(max_retries=UPLOAD_RETRY, pool_maxsize=HTTP_POOL_SIZE, pool_block=False))
+
+# Storage Client, created on first use to keep credential lookup off the import path
+_storage_client = None
+
+def _gcs():
+    """Returns the shared Storage client, creating it with a pool sized for parallel downloads."""
+    global _storage_client
+    if _storage_client is None:
+        credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+        http = AuthorizedSession(credentials)
+        http.mount("https://", HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+        _storage_client = storage.Client(project=project, credentials=credentials, _http=http)
+    return _storage_client
 
 def get_elevenlabs_docs():
-    """Fetches all documents currently in the ElevenLabs Knowledge Base."""
-    headers = {"xi-api-key": ELEVENLABS_API_KEY}
+    """Fetches all documents currently in the ElevenLabs Knowledge Base as {name: [doc_id, ...]}. Returns None if the listing is incomplete."""
     documents = {} 
     
     next_cursor = None
     while True:
-        params = {"page_size": 100}
+        params = {"page_size": KB_PAGE_SIZE}
         if next_cursor:
             params["cursor"] = next_cursor
             
-        response = requests.get(
-            f"{ELEVENLABS_API_URL}/convai/knowledge-base",
-            headers=headers,
-            params=params
-        )
-        
+        try:
+            response = SESSION.get(
+                f"{ELEVENLABS_API_URL}/convai/knowledge-base",
+                params=params,
+                timeout=REQUEST_TIMEOUT
+            )
+        except requests.RequestException as e:
+            logger.error("Error listing docs: %s", e)
+            return None
+
+        # A partial map would make every missing file look new and get uploaded again
         if response.status_code != 200:
-            print(f"Error listing docs: {response.text}")
-            break
+            logger.error("Error listing docs: %s", response.text)
+            return None
             
         data = response.json()
+        # Keep every ID: a name can be listed more than once after an interrupted replace
         for doc in data.get("documents", []):
-            documents[doc["name"]] = doc["id"]
+            documents.setdefault(doc["name"], []).append(doc["id"])
             
         if not data.get("has_more"):
             break
@@ -47,95 +140,128 @@ def get_elevenlabs_docs():
 
 def delete_elevenlabs_doc(doc_id):
     """Deletes a document from ElevenLabs."""
-    headers = {"xi-api-key": ELEVENLABS_API_KEY}
-    response = requests.delete(
-        f"{ELEVENLABS_API_URL}/convai/knowledge-base/{doc_id}",
-        headers=headers
-    )
+    try:
+        response = SESSION.delete(
+            f"{ELEVENLABS_API_URL}/convai/knowledge-base/{doc_id}",
+            timeout=REQUEST_TIMEOUT
+        )
+    except requests.RequestException as e:
+        logger.warning("Failed to delete doc %s: %s", doc_id, e)
+        return False
+
     if response.status_code == 200 or response.status_code == 204:
-        print(f"Deleted doc ID: {doc_id}")
+        logger.debug("Deleted doc ID: %s", doc_id)
+        return True
     else:
-        print(f"Failed to delete doc {doc_id}: {response.text}")
+        logger.warning("Failed to delete doc %s: %s", doc_id, response.text)
+        return False
+
+def delete_elevenlabs_docs(doc_ids):
+    """Deletes several documents concurrently over the shared session's connection pool. Returns the deleted IDs."""
+    # The API has no batch delete endpoint, so fan the single DELETEs out instead
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        results = list(ex.map(delete_elevenlabs_doc, doc_ids))
+    return [doc_id for doc_id, deleted in zip(doc_ids, results) if deleted]
 
 def upload_file_to_elevenlabs(bucket_name, blob_name):
     """Downloads file from GCS and uploads to ElevenLabs with strict MIME type mapping."""
-    bucket = storage_client.bucket(bucket_name)
+    bucket = _gcs().bucket(bucket_name)
     blob = bucket.blob(blob_name)
     
-    # 1. Map extensions to ElevenLabs specific allowed types
-    ext_mapping = {
-        '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        '.pdf': 'application/pdf',
-        '.txt': 'text/plain',
-        '.epub': 'application/epub+zip',
-        '.html': 'text/html',
-        '.md': 'text/markdown'
-    }
-    
     _, ext = os.path.splitext(blob_name.lower())
-    content_type = ext_mapping.get(ext)
-    
-    # Fallback to mimetypes if not in our manual list
-    if not content_type:
-        content_type, _ = mimetypes.guess_type(blob_name)
-        if not content_type:
-            content_type = 'text/plain' # Safest fallback for LLM ingestion
+    content_type = EXT_MIME.get(ext, 'text/plain') # Safest fallback for LLM ingestion
 
-    _, temp_local_filename = tempfile.mkstemp()
-    
+    # We send only the filename, not the full GCS path/folder structure if present
+    display_name = os.path.basename(blob_name)
+    args = {'name': display_name}
+
+    # requests builds the multipart body in memory anyway, so read the object straight
+    # into it: no local temp file, and the download is still checksum-verified
     try:
-        blob.download_to_filename(temp_local_filename)
-        headers = {"Xi-api-key": ELEVENLABS_API_KEY}
-        
-        # We send only the filename, not the full GCS path/folder structure if present
-        display_name = os.path.basename(blob_name)
-        args = {'name': display_name} 
-        
-        with open(temp_local_filename, 'rb') as f:
-            files = {'file': (display_name, f, content_type)}
-            response = requests.post(
-                f"{ELEVENLABS_API_URL}/convai/knowledge-base/file",
-                headers=headers,
-                data=args,
-                files=files
-            )
-            
-        if response.status_code == 200:
-            data = response.json()
-            print(f"Uploaded {display_name} as {content_type}, ID: {data['id']}")
-            return data['id']
-        else:
-            print(f"Failed to upload {blob_name}: {response.text}")
-            return None
-    finally:
-        if os.path.exists(temp_local_filename):
-            os.remove(temp_local_filename)
+        content = blob.download_as_bytes()
+        files = {'file': (display_name, content, content_type)}
+        response = UPLOAD_SESSION.post(
+            f"{ELEVENLABS_API_URL}/convai/knowledge-base/file",
+            data=args,
+            files=files,
+            timeout=UPLOAD_TIMEOUT
+        )
+    except (gcs_exceptions.GoogleAPICallError, requests.RequestException) as e:
+        # e.g. the object was deleted mid-reconcile, or the upload timed out after retries
+        logger.warning("Failed to upload %s: %s", blob_name, e)
+        return None
 
-def update_agent_knowledge(valid_docs):
-    """Updates the agent to use the new list of documents."""
-    headers = {
-        "xi-api-key": ELEVENLABS_API_KEY,
-        "Content-Type": "application/json"
-    }
+    if response.status_code == 200:
+        data = response.json()
+        logger.debug("Uploaded %s as %s, ID: %s", display_name, content_type, data['id'])
+        return data['id']
+    else:
+        logger.warning("Failed to upload %s: %s", blob_name, response.text)
+        return None
+
+def _load_manifest(bucket):
+    """Reads the cached ElevenLabs manifest from the bucket. Returns (manifest or None, generation)."""
+    blob = bucket.get_blob(MANIFEST_BLOB_NAME)
+    if blob is None:
+        return None, 0
 
     try:
-        get_resp = requests.get(
-            f"{ELEVENLABS_API_URL}/convai/agents/{ELEVENLABS_AGENT_ID}",
-            headers=headers
+        manifest = orjson.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+    except (ValueError, gcs_exceptions.GoogleAPICallError) as e:
+        logger.warning("Could not read manifest: %s", e)
+        return None, blob.generation
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        logger.info("Manifest version mismatch. Ignoring cached manifest.")
+        return None, blob.generation
+    return manifest, blob.generation
+
+def _kb_hash(docs):
+    """Stable hash of a manifest docs map, used to detect an unchanged knowledge base."""
+    pairs = sorted((entry["id"], name) for name, entry in docs.items())
+    return hashlib.sha1(json.dumps(pairs).encode()).hexdigest()
+
+def _cached_md5(manifest, filename, doc_id):
+    """Returns the md5 the manifest recorded for filename, if it still refers to doc_id."""
+    entry = (manifest or {}).get("docs", {}).get(filename)
+    if entry and entry["id"] == doc_id:
+        return entry.get("md5")
+    return None
+
+def _to_manifest_docs(valid_docs):
+    """Converts a valid_docs list into the manifest's {filename: {id, md5}} map."""
+    return {doc.name: {'id': doc.id, 'md5': doc.md5} for doc in valid_docs}
+
+def _from_manifest_docs(docs):
+    """Converts the manifest's {filename: {id, md5}} map back into a valid_docs list."""
+    return [Doc(entry['id'], name, entry.get('md5')) for name, entry in docs.items()]
+
+def _save_manifest(bucket, docs, reconciled_at, generation):
+    """Writes the manifest back, only if nobody else replaced it since we read it. Returns whether it was written."""
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "reconciled_at": reconciled_at,
+        "kb_hash": _kb_hash(docs),
+        "docs": docs
+    }
+    blob = bucket.blob(MANIFEST_BLOB_NAME)
+    try:
+        blob.upload_from_string(
+            orjson.dumps(manifest),
+            content_type="application/json",
+            if_generation_match=generation
         )
-        if get_resp.status_code != 200:
-            print(f"Warning: Could not fetch agent ({get_resp.status_code}). Proceeding with update.")
-    except Exception as e:
-         print(f"Exception fetching agent: {e}. Proceeding with update.")
-
-    new_kb_config = []
-    for doc in valid_docs:
-        new_kb_config.append({
-            "type": "file",
-            "id": doc['id'],
-            "name": doc['name'],
-            "usage_mode": "auto"
-        })
+    except gcs_exceptions.PreconditionFailed:
+        logger.debug("Manifest was updated concurrently. Not saved.")
+        return False
+    return True
+
+def update_agent_knowledge(valid_docs):
+    """Updates the agent to use the new list of documents."""
+    new_kb_config = [
+        {"type": "file", "id": doc.id, "name": doc.name, "usage_mode": "auto"}
+        for doc in valid_docs
+    ]
 
     patch_data = {
         "conversation_config": {
@@ -147,16 +273,260 @@ def update_agent_knowledge(valid_docs):
         }
     }
 
-    patch_resp = requests.patch(
-        f"{ELEVENLABS_API_URL}/convai/agents/{ELEVENLABS_AGENT_ID}",
-        headers=headers,
-        json=patch_data
-    )
+    try:
+        patch_resp = SESSION.patch(
+            f"{ELEVENLABS_API_URL}/convai/agents/{ELEVENLABS_AGENT_ID}",
+            data=orjson.dumps(patch_data),
+            headers={"Content-Type": "application/json"},
+            timeout=REQUEST_TIMEOUT
+        )
+    except requests.RequestException as e:
+        logger.error("Failed to update agent: %s", e)
+        return False
 
     if patch_resp.status_code == 200:
-        print("Agent configuration successfully updated.")
+        logger.debug("Agent configuration successfully updated.")
+        return True
+    else:
+        logger.error("Failed to update agent: %s", patch_resp.text)
+        # Only look the agent up when something went wrong, to help diagnose the failure
+        try:
+            get_resp = SESSION.get(
+                f"{ELEVENLABS_API_URL}/convai/agents/{ELEVENLABS_AGENT_ID}",
+                timeout=REQUEST_TIMEOUT
+            )
+            if get_resp.status_code != 200:
+                logger.warning("Could not fetch agent (%s).", get_resp.status_code)
+        except Exception as e:
+            logger.warning("Exception fetching agent: %s", e)
+        return False
+
+def _record_delete(stats, doc_id, deleted):
+    """Adds the outcome of a single document delete to the sync stats."""
+    if deleted:
+        stats["deleted"].append(doc_id)
+    else:
+        stats["errors"].append(f"delete failed: {doc_id}")
+
+def _record_deletes(stats, doc_ids):
+    """Deletes several documents concurrently and adds the outcomes to the sync stats."""
+    deleted = delete_elevenlabs_docs(doc_ids)
+    stats["deleted"].extend(deleted)
+    if len(deleted) < len(doc_ids):
+        failed = set(doc_ids) - set(deleted)
+        stats["errors"].extend(f"delete failed: {doc_id}" for doc_id in failed)
+
+def _log_summary(bucket_name, triggered_file_name, mode, stats):
+    """Emits the single structured log record for a sync."""
+    errors = stats["errors"]
+    summary = {
+        "severity": "WARNING" if errors else "INFO",
+        "message": "Sync complete",
+        "bucket": bucket_name,
+        "trigger": triggered_file_name,
+        "mode": mode,
+        "uploaded": len(stats["uploaded"]),
+        "deleted": len(stats["deleted"]),
+        "unchanged": stats["unchanged"],
+        "error_count": len(errors),
+        "errors": errors[:MAX_LOGGED_ERRORS]
+    }
+    logger.log(logging.WARNING if errors else logging.INFO, json.dumps(summary))
+
+def _handle_finalize(bucket, filename, md5_hash, manifest, generation, stats):
+    """Uploads a single new/changed file and swaps it into the agent using the cached manifest."""
+    old_entry = manifest["docs"].get(filename)
+
+    # Metadata-only updates and identical re-uploads keep the same md5
+    if md5_hash and old_entry and old_entry.get("md5") == md5_hash:
+        logger.debug("File %s unchanged (md5 match). Skipping upload.", filename)
+        stats["unchanged"] += 1
+        return
+
+    logger.debug("File %s %s. Uploading...", filename, 'changed' if old_entry else 'is new')
+    new_id = upload_file_to_elevenlabs(bucket.name, filename)
+    if not new_id:
+        stats["errors"].append(f"upload failed: {filename}")
+        return
+    stats["uploaded"].append(filename)
+
+    patched = False # Whether the agent has been pointed at new_id by an earlier round
+    for _ in range(MANIFEST_SAVE_ATTEMPTS):
+        docs = dict(manifest["docs"])
+        old_entry = docs.get(filename)
+        # A concurrent event may already have uploaded this exact content
+        if md5_hash and old_entry and old_entry.get("md5") == md5_hash:
+            logger.debug("File %s was already uploaded concurrently. Dropping our copy.", filename)
+            # Our own PATCH may have landed after theirs; point the agent back at their doc first
+            if patched and not update_agent_knowledge(_from_manifest_docs(docs)):
+                stats["errors"].append("agent update failed")
+                return
+            _record_delete(stats, new_id, delete_elevenlabs_doc(new_id))
+            return
+
+        docs[filename] = {'id': new_id, 'md5': md5_hash}
+        if not update_agent_knowledge(_from_manifest_docs(docs)):
+            stats["errors"].append("agent update failed")
+            if patched:
+                break # The agent already references new_id, let the reconcile settle it
+            # Nothing references new_id, don't leave it behind as an untracked same-named copy
+            _record_delete(stats, new_id, delete_elevenlabs_doc(new_id))
+            return
+        patched = True
+        # Only once the manifest records new_id is it safe to drop the previous doc
+        if _save_manifest(bucket, docs, manifest["reconciled_at"], generation):
+            if old_entry:
+                _record_delete(stats, old_entry["id"], delete_elevenlabs_doc(old_entry["id"]))
+            return
+
+        manifest, generation = _load_manifest(bucket)
+        if manifest is None:
+            break
+
+    _fallback_reconcile(bucket, filename, stats, pinned={filename: {'id': new_id, 'md5': md5_hash}})
+
+def _handle_delete(bucket, filename, manifest, generation, stats):
+    """Detaches and deletes the document for a single removed file using the cached manifest."""
+    # Overwrites also emit a delete for the old generation, the finalize event handles those
+    if bucket.get_blob(filename) is not None:
+        logger.debug("File %s still exists (overwritten). Nothing to delete.", filename)
+        return
+
+    for _ in range(MANIFEST_SAVE_ATTEMPTS):
+        docs = dict(manifest["docs"])
+        old_entry = docs.pop(filename, None)
+        if old_entry is None:
+            logger.debug("File %s is not tracked in the manifest. Nothing to delete.", filename)
+            return
+
+        logger.debug("File %s removed from bucket. Deleting...", filename)
+        if not update_agent_knowledge(_from_manifest_docs(docs)):
+            stats["errors"].append("agent update failed")
+            return
+        if _save_manifest(bucket, docs, manifest["reconciled_at"], generation):
+            _record_delete(stats, old_entry["id"], delete_elevenlabs_doc(old_entry["id"]))
+            return
+
+        manifest, generation = _load_manifest(bucket)
+        if manifest is None:
+            break
+
+    _fallback_reconcile(bucket, filename, stats)
+
+def _fallback_reconcile(bucket, filename, stats, pinned=None):
+    """Runs a full reconcile after a single-file change could not be committed to the manifest."""
+    logger.warning("Could not commit %s to the manifest. Falling back to a full reconcile.", filename)
+    stats["errors"].append(f"manifest conflict: {filename}")
+    manifest, generation = _load_manifest(bucket)
+    if pinned:
+        # pinned {filename: {id, md5}} entries win over same-named copies in the listing. Our
+        # earlier PATCHes may not match the stored kb_hash, so never skip the agent update.
+        manifest = dict(manifest or {})
+        manifest["docs"] = {**manifest.get("docs", {}), **pinned}
+        manifest.pop("kb_hash", None)
+    # No triggering event: the file's current doc is taken from the listing, not re-uploaded
+    _reconcile(bucket, None, None, manifest, generation, stats)
+
+def _reconcile(bucket, triggered_file_name, event_type, manifest, generation, stats):
+    """Full pass: diffs every object in the bucket against every document in ElevenLabs."""
+    # Partial response: only the fields we actually read, in as few pages as possible
+    gcs_blobs = list(bucket.list_blobs(
+        fields="items(name,generation,md5Hash,etag),nextPageToken",
+        page_size=1000
+    ))
+    gcs_map = {blob.name: blob for blob in gcs_blobs if blob.name != MANIFEST_BLOB_NAME}
+
+    el_listing = get_elevenlabs_docs()
+    if el_listing is None:
+        stats["errors"].append("knowledge base listing failed")
+        return
+    reconciled_at = time.time()
+
+    # One doc per name: prefer the one the manifest tracks, delete the other copies
+    el_docs = {}
+    duplicate_ids = []
+    for name, doc_ids in el_listing.items():
+        entry = (manifest or {}).get("docs", {}).get(name)
+        keep = entry["id"] if entry and entry["id"] in doc_ids else doc_ids[-1]
+        el_docs[name] = keep
+        duplicate_ids.extend(doc_id for doc_id in doc_ids if doc_id != keep)
+
+    gcs_names = set(gcs_map)
+    el_names = set(el_docs)
+    new_names = gcs_names - el_names
+    removed_names = el_names - gcs_names
+    unchanged_names = gcs_names & el_names
+
+    to_upload = [(filename, None) for filename in sorted(new_names)] # (filename, old_id or None)
+    if logger.isEnabledFor(logging.DEBUG):
+        for filename in sorted(new_names):
+            logger.debug("File %s is new. Uploading...", filename)
+
+    if event_type == FINALIZED_EVENT and triggered_file_name in unchanged_names:
+        old_id = el_docs[triggered_file_name]
+        cached_md5 = _cached_md5(manifest, triggered_file_name, old_id)
+        if not cached_md5 or cached_md5 != gcs_map[triggered_file_name].md5_hash:
+            logger.debug("File %s changed. Uploading new version...", triggered_file_name)
+            unchanged_names.discard(triggered_file_name)
+            to_upload.append((triggered_file_name, old_id))
+
+    valid_docs = [
+        Doc(el_docs[filename], filename, _cached_md5(manifest, filename, el_docs[filename]))
+        for filename in sorted(unchanged_names)
+    ]
+    stats["unchanged"] += len(unchanged_names)
+
+    ids_to_delete = [el_docs[filename] for filename in removed_names] + duplicate_ids
+    if logger.isEnabledFor(logging.DEBUG):
+        for filename in removed_names:
+            logger.debug("File %s removed from bucket. Marking for deletion.", filename)
+
+    replacement_ids = [] # New IDs of re-uploaded files, whose old doc is still attached until the PATCH lands
+    if to_upload:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            futures = {
+                ex.submit(upload_file_to_elevenlabs, bucket.name, filename): (filename, old_id)
+                for filename, old_id in to_upload
+            }
+            for future in as_completed(futures):
+                filename, old_id = futures[future]
+                new_id = future.result()
+                if new_id:
+                    stats["uploaded"].append(filename)
+                    valid_docs.append(Doc(new_id, filename, gcs_map[filename].md5_hash))
+                    if old_id:
+                        ids_to_delete.append(old_id)
+                        replacement_ids.append(new_id)
+                    continue
+                stats["errors"].append(f"upload failed: {filename}")
+                if old_id:
+                    # Keep serving the previous version rather than dropping the file
+                    valid_docs.append(Doc(old_id, filename, _cached_md5(manifest, filename, old_id)))
+
+    # Uploads complete in any order; keep the agent's knowledge_base array stable across syncs
+    valid_docs.sort(key=lambda doc: doc.name)
+    docs = _to_manifest_docs(valid_docs)
+    if manifest and not ids_to_delete and manifest.get("kb_hash") == _kb_hash(docs):
+        # Agent already points at exactly these docs, just refresh the reconcile time
+        logger.debug("Knowledge base unchanged. Skipping agent update.")
+        if not _save_manifest(bucket, docs, reconciled_at, generation):
+            stats["errors"].append("manifest conflict during reconcile")
     else:
-        print(f"Failed to update agent: {patch_resp.text}")
+        logger.debug("Updating Agent to use %d documents...", len(valid_docs))
+        if update_agent_knowledge(valid_docs):
+            if not _save_manifest(bucket, docs, reconciled_at, generation):
+                stats["errors"].append("manifest conflict during reconcile")
+        else:
+            # The agent may still reference the replaced docs, keep them all and drop
+            # their replacements instead, which would otherwise linger as same-named copies
+            stats["errors"].append("agent update failed")
+            if replacement_ids:
+                _record_deletes(stats, replacement_ids)
+            return
+
+    if ids_to_delete:
+        logger.debug("Deleting %d orphaned documents...", len(ids_to_delete))
+        _record_deletes(stats, ids_to_delete)
 
 @functions_framework.cloud_event
 def sync_knowledge_base(cloud_event):
@@ -165,44 +535,28 @@ def sync_knowledge_base(cloud_event):
     triggered_file_name = data.get("name")
     event_type = cloud_event["type"]
 
-    print(f"Sync started for bucket: {bucket_name}, trigger: {triggered_file_name}")
-
-    bucket = storage_client.bucket(bucket_name)
-    gcs_blobs = list(bucket.list_blobs())
-    gcs_map = {blob.name: blob for blob in gcs_blobs} 
-    
-    el_docs = get_elevenlabs_docs()
-    
-    valid_docs = []
-    ids_to_delete = []
-
-    for filename, blob in gcs_map.items():
-        if filename in el_docs:
-            if filename == triggered_file_name and event_type == "google.cloud.storage.object.v1.finalized":
-                print(f"File {filename} changed. Uploading new version...")
-                new_id = upload_file_to_elevenlabs(bucket_name, filename)
-                if new_id:
-                    valid_docs.append({'id': new_id, 'name': filename})
-                    ids_to_delete.append(el_docs[filename])
-            else:
-                valid_docs.append({'id': el_docs[filename], 'name': filename})
-        else:
-            print(f"File {filename} is new. Uploading...")
-            new_id = upload_file_to_elevenlabs(bucket_name, filename)
-            if new_id:
-                valid_docs.append({'id': new_id, 'name': filename})
+    # Our own manifest writes land in the same bucket, don't sync on them
+    if triggered_file_name == MANIFEST_BLOB_NAME:
+        return "Ignored manifest update"
 
-    for filename, doc_id in el_docs.items():
-        if filename not in gcs_map:
-            print(f"File {filename} removed from bucket. Marking for deletion.")
-            ids_to_delete.append(doc_id)
+    logger.debug("Sync started for bucket: %s, trigger: %s", bucket_name, triggered_file_name)
+    stats = {"uploaded": [], "deleted": [], "unchanged": 0, "errors": []}
 
-    print(f"Updating Agent to use {len(valid_docs)} documents...")
-    update_agent_knowledge(valid_docs)
+    bucket = _gcs().bucket(bucket_name)
+    manifest, manifest_generation = _load_manifest(bucket)
+    manifest_fresh = manifest and time.time() - manifest.get("reconciled_at", 0) < MANIFEST_MAX_AGE
 
-    if ids_to_delete:
-        print(f"Deleting {len(ids_to_delete)} orphaned documents...")
-        for doc_id in ids_to_delete:
-            delete_elevenlabs_doc(doc_id)
+    # Single-object events only touch that object; anything else (e.g. a scheduled
+    # trigger) or a missing/stale manifest falls back to the full reconcile
+    if manifest_fresh and event_type == FINALIZED_EVENT:
+        mode = "finalize"
+        _handle_finalize(bucket, triggered_file_name, data.get("md5Hash"), manifest, manifest_generation, stats)
+    elif manifest_fresh and event_type == DELETED_EVENT:
+        mode = "delete"
+        _handle_delete(bucket, triggered_file_name, manifest, manifest_generation, stats)
+    else:
+        mode = "reconcile"
+        _reconcile(bucket, triggered_file_name, event_type, manifest, manifest_generation, stats)
 
+    _log_summary(bucket_name, triggered_file_name, mode, stats)
     return "Sync complete"